@@ -12,20 +12,40 @@ Behavior:
 - Payment flow unchanged.
 """
 import os
-import json
+import atexit
 import time
 import logging
 import threading
+import queue
 import requests
+import urllib3
 import hmac
 import hashlib
 import random
+import socket
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from html import escape
 from io import BytesIO
-from flask import Flask, request, jsonify
-
-from sqlalchemy import create_engine, Column, String, BigInteger, Float, JSON as SA_JSON
+from secrets import token_hex
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+from sqlalchemy import create_engine, bindparam, select, text, Column, Index, String, BigInteger, Float, JSON as SA_JSON
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base
 
+try:
+    import orjson
+except Exception:
+    raise RuntimeError("orjson is required. Install with: pip install orjson")
+
 # Image processing
 try:
     from PIL import Image, ImageOps
@@ -38,7 +58,13 @@ API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}" if BOT_TOKEN else None
 
 NOWPAYMENTS_API_KEY = os.getenv("NOWPAYMENTS_API_KEY")
 NOWPAYMENTS_IPN_SECRET = os.getenv("NOWPAYMENTS_IPN_SECRET")
+# NowPayments payment_status values that mean the money arrived (what the status poll accepts)
+NP_PAID_PAYMENT_STATUSES = frozenset(("finished", "confirmed"))
+# IPN statuses that mean the order is paid: the above plus the aliases some IPN payloads use
+PAID_STATUSES = NP_PAID_PAYMENT_STATUSES | {"paid", "success"}
 PUBLIC_URL = os.getenv("PUBLIC_URL", "https://example.com")
+# Private chat (e.g. an admin channel) the demos are uploaded to at startup to pre-fill the file_id cache; unset = off.
+WARMUP_CHAT_ID = os.getenv("WARMUP_CHAT_ID")
 
 APP_NAME = "Mythic AI Store"
 
@@ -54,11 +80,23 @@ PRICES = {
     "video3": 5.0,
 }
 
-# Helper to build direct-download URL for Google Drive file id
+# Drive file id inside the usual share-link shapes: /file/d/<id>/view, /d/<id>/edit, open?id=<id>, uc?export=download&id=<id>
+DRIVE_ID_RE = re.compile(r"(?:/d/|[?&]id=)([A-Za-z0-9_-]{10,})")
+
+
+def drive_file_id(url: str):
+    m = DRIVE_ID_RE.search(url)
+    return m.group(1) if m else None
+
+
+# Helper to build direct-download URL for Google Drive file id (a pasted share link works too)
 def gdrive_uc_url(file_id: str) -> str:
+    if "/" in file_id:
+        file_id = drive_file_id(file_id) or file_id
     return f"https://drive.google.com/uc?export=download&id={file_id}"
 
 # ---------------- PACKS & DEMO POOL ----------------
+# A pack ships either one "deliver_url" or a "deliver_urls" list (sent as albums once uploaded).
 PACKS = {
     "face_pack": {
         "id": "face_pack",
@@ -110,7 +148,17 @@ PACKS = {
     },
 }
 
-DEMO_POOL = [
+# Derived per-pack fields, filled once here rather than rebuilt per callback:
+#   caption    - HTML title/description shown with the pack and its demo
+#   demo_media - demo_url, or the placeholder for the pack's type
+# plus the pack lists per type ("image"/"video"), in catalog order.
+PACKS_BY_TYPE = {}
+for _p in PACKS.values():
+    _p["caption"] = f"<b>{_p['title']}</b>\n{_p['description']}"
+    _p["demo_media"] = _p.get("demo_url") or (DEFAULT_DEMO_VIDEO if _p["type"] == "video" else DEFAULT_DEMO_IMAGE)
+    PACKS_BY_TYPE.setdefault(_p["type"], []).append(_p)
+
+DEMO_POOL = (
     gdrive_uc_url("1nzThkEqpE4r2op9RQxodZn34ICGcWSNu"),
     gdrive_uc_url("1CvfO009_kAgvK147-kbVbzmGW4cLHnxo"),
     gdrive_uc_url("1K8rYumafJFPnTGU9JlwWY_udjWBYNDe0"),
@@ -120,18 +168,73 @@ DEMO_POOL = [
     gdrive_uc_url("1-gdYEM-Rs2I7WpXXGFCzlxldIKcY49J6"),
     gdrive_uc_url("1cpA9pDIBpXCYC1lWha63q8x0VaPGSs6M"),
     gdrive_uc_url("1b9p1TPrRwLHFJV42_FcEfFoke_aClomH"),
-]
+)
 
-# Demo usage tracking (in-memory). Maps user_id -> last_demo_epoch_seconds
-DEMO_USAGE = {}
+# Demo usage tracking (in-memory). Maps user_id -> last_demo_epoch_seconds, oldest first.
+DEMO_USAGE = OrderedDict()
+DEMO_USAGE_LOCK = threading.Lock()
+DEMO_USAGE_MAX = 100000
 DEMO_COOLDOWN_SECONDS = 24 * 3600  # 24 hours
 
 # ---------------- Logging ----------------
-logging.basicConfig(level=logging.INFO)
+# Platform logs (Koyeb) already timestamp each line; skip the per-record caller/thread/process lookups too.
+logging._srcfile = None
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging.basicConfig(level=logging.INFO, format="%(levelname).1s %(name)s %(message)s")
 logger = logging.getLogger("mythic-bot")
 
+# Checked at import so gunicorn workers report missing config too, not only `python app.py`.
+if not BOT_TOKEN:
+    logger.warning("BOT_TOKEN is NOT set. Telegram messages will fail.")
+if not NOWPAYMENTS_API_KEY:
+    logger.warning("NOWPAYMENTS_API_KEY is NOT set. Invoices will be simulated.")
+
 # ---------------- Flask ----------------
+class OrjsonProvider(JSONProvider):
+    # jsonify()/get_json() through orjson, like the rest of the app's JSON
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Updates are handled on a fixed pool of workers sharing the Telegram pools, instead of one OS thread per update.
+# The queue is bounded so a burst can't pile up unbounded work; overflow is dropped (and counted, see /metrics).
+UPDATE_WORKERS = int(os.getenv("BOT_WORKERS", "32"))
+UPDATE_QUEUE = queue.Queue(maxsize=1024)
+UPDATE_STATS = {"received": 0, "dropped": 0}
+
+
+def update_worker():
+    while True:
+        update = UPDATE_QUEUE.get()
+        try:
+            handle_update(update)
+        finally:
+            UPDATE_QUEUE.task_done()
+
+
+for _ in range(UPDATE_WORKERS):
+    threading.Thread(target=update_worker, name="update-worker", daemon=True).start()
+
+
+def drain_updates(timeout=20):
+    # the workers are daemon threads: on shutdown give updates Telegram already got a 200 for a chance to finish,
+    # then the deliveries they queued (orders they marked paid). Both are plain queues, which unlike a
+    # concurrent.futures executor keep accepting work after threading's shutdown hooks have run.
+    deadline = time.monotonic() + timeout
+    for q in (UPDATE_QUEUE, DELIVERY_QUEUE):
+        while q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+atexit.register(drain_updates)
 
 # ---------------- Database (SQLAlchemy) ----------------
 DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("Postgres.DATABASE_URL") or os.getenv("Postgres.DATABASE")
@@ -139,58 +242,168 @@ if not DATABASE_URL:
     DATABASE_URL = os.getenv("LOCAL_DATABASE_URL", "sqlite:///local.db")
     logger.warning("DATABASE_URL is not set. Falling back to local sqlite (development only).")
 
-connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+# invoice/tx_info JSON goes through orjson instead of stdlib json on every read and write
+# (on psycopg2 SQLAlchemy registers the deserializer as the driver's json/jsonb typecaster)
+JSON_CODEC = {"json_serializer": lambda obj: orjson.dumps(obj).decode(), "json_deserializer": orjson.loads}
+if DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **JSON_CODEC)
+else:
+    # sized for UPDATE_WORKERS handlers plus webhook requests; pre_ping/recycle drop connections
+    # the server (or a Postgres restart) closed while they sat idle in the pool
+    engine = create_engine(DATABASE_URL, pool_size=20, max_overflow=40, pool_pre_ping=True, pool_recycle=300,
+                           **JSON_CODEC)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
+# binary JSONB on Postgres for new tables (create_all leaves existing json columns as they are)
+JSON_TYPE = SA_JSON().with_variant(JSONB(), "postgresql")
 
 
 class Order(Base):
     __tablename__ = "orders"
-    order_id = Column(String, primary_key=True, index=True)
-    user_id = Column(BigInteger, nullable=False, index=True)
+    order_id = Column(String, primary_key=True)  # the primary key is already unique-indexed
+    user_id = Column(BigInteger, nullable=False)  # covered by ix_orders_user_created (leading column)
     product_id = Column(String, nullable=False)
     price = Column(Float, nullable=False)
     currency = Column(String, nullable=False, default="USDT")
     status = Column(String, nullable=False, default="pending")
-    invoice = Column(SA_JSON, nullable=True)
+    invoice = Column(JSON_TYPE, nullable=True)
     created_at = Column(BigInteger, nullable=False)  # epoch seconds
     paid_at = Column(BigInteger, nullable=True)
-    tx_info = Column(SA_JSON, nullable=True)
+    tx_info = Column(JSON_TYPE, nullable=True)
+
+
+# "orders" lists a user's newest orders first; this serves it as an ordered index scan.
+ORDERS_USER_CREATED_IX = Index("ix_orders_user_created", Order.user_id, Order.created_at.desc())
+
+
+class MediaFile(Base):
+    # Telegram file_id of media we already uploaded, keyed by the source URL it came from.
+    __tablename__ = "media_files"
+    url = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)  # photo / video / document
+    file_id = Column(String, nullable=False)
+    created_at = Column(BigInteger, nullable=False)  # epoch seconds
+
+
+class ProcessedWebhook(Base):
+    # NowPayments retries IPNs; one row per (payment, status) already handled.
+    __tablename__ = "processed_webhooks"
+    key = Column(String, primary_key=True)
+    received_at = Column(BigInteger, nullable=False)  # epoch seconds
 
 
 Base.metadata.create_all(bind=engine)
+# create_all skips indexes on tables that already exist, and never drops the redundant ones older deploys made
+ORDERS_USER_CREATED_IX.create(bind=engine, checkfirst=True)
+with engine.begin() as conn:
+    conn.execute(text("DROP INDEX IF EXISTS ix_orders_user_id"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_orders_order_id"))
 
 # ---------------- Telegram helpers ----------------
-def telegram_request_json(method: str, payload: dict, timeout=20):
+# Shared keep-alive pools for api.telegram.org; never mutated after init so they are safe to share across threads.
+TG_RETRY = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+# urllib3 already sets TCP_NODELAY; SO_KEEPALIVE lets the OS notice pooled sockets that died while idle.
+TG_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+class TelegramAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = TG_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Small JSON calls (sendMessage, answerCallbackQuery, ...) go straight through urllib3,
+# skipping requests' session/hook/cookie layers. One keep-alive slot per thread that can call it
+# (update, send, delivery and startup warmup workers); beyond maxsize urllib3 would open and then discard
+# extra connections, paying a fresh TLS handshake each time under load.
+SEND_WORKERS = 16
+DELIVERY_WORKERS = 4
+WARMUP_WORKERS = 8
+TG_HTTP = urllib3.PoolManager(num_pools=1, maxsize=UPDATE_WORKERS + SEND_WORKERS + DELIVERY_WORKERS + WARMUP_WORKERS,
+                              retries=TG_RETRY, socket_options=TG_SOCKET_OPTIONS)
+
+# Multipart uploads (large, long-lived) get their own smaller pool so a burst of media sends can't
+# starve the short calls above; requests handles the file encoding.
+TG_MEDIA_SESSION = requests.Session()
+TG_MEDIA_SESSION.mount("https://", TelegramAdapter(pool_connections=1, pool_maxsize=8, max_retries=TG_RETRY))
+
+
+def prime_telegram_dns():
+    # resolve once off the request path so a caching resolver (nscd/systemd-resolved/dnsmasq) is warm
+    # before the first update arrives; pointless where nothing caches, hence opt-in
+    try:
+        socket.getaddrinfo("api.telegram.org", 443, type=socket.SOCK_STREAM)
+    except OSError as e:
+        logger.warning("DNS prime for api.telegram.org failed: %s", e)
+
+
+if os.getenv("DNS_PRIME", "0") == "1":
+    threading.Thread(target=prime_telegram_dns, name="dns-prime", daemon=True).start()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Full endpoint URL per Bot API method the app calls; built once instead of formatted per request.
+TG_METHOD_URLS = {
+    m: f"{API_URL}/{m}"
+    for m in ("sendMessage", "editMessageText", "answerCallbackQuery", "sendPhoto", "sendVideo",
+              "sendAnimation", "sendDocument", "sendMediaGroup", "deleteMessage")
+} if API_URL else {}
+
+# Paid-order deliveries: slow uploads, kept apart from the quick fire-and-forget sends (SEND_QUEUE).
+# A plain unbounded queue with daemon drainers: put() can't fail, even during interpreter shutdown when
+# a concurrent.futures executor would refuse new work after the order was already marked paid.
+DELIVERY_QUEUE = queue.Queue()
+
+
+def delivery_worker():
+    while True:
+        user_id, product_id, order_id = DELIVERY_QUEUE.get()
+        try:
+            deliver_order(user_id, product_id, order_id)
+        finally:
+            DELIVERY_QUEUE.task_done()
+
+
+def queue_delivery(user_id, product_id, order_id):
+    DELIVERY_QUEUE.put((user_id, product_id, order_id))
+
+
+for _ in range(DELIVERY_WORKERS):
+    threading.Thread(target=delivery_worker, name="delivery-worker", daemon=True).start()
+
+
+def telegram_request_json(method: str, payload: dict, timeout=urllib3.Timeout(connect=3.05, read=15)):
     if not API_URL:
         logger.error("BOT_TOKEN is not set")
         return None
-    url = f"{API_URL}/{method}"
+    url = TG_METHOD_URLS.get(method) or f"{API_URL}/{method}"
+    # payload may already be encoded (see send_prerendered)
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
     try:
-        r = requests.post(url, json=payload, timeout=timeout)
-        if r.status_code != 200:
-            logger.warning("Telegram API returned %s: %s", r.status_code, r.text)
+        r = TG_HTTP.request("POST", url, body=body, headers=JSON_HEADERS, timeout=timeout)
+        if r.status != 200:
+            logger.warning("Telegram API returned %s: %s", r.status, r.data)
         try:
-            return r.json()
+            return orjson.loads(r.data)
         except Exception:
-            return {"ok": False, "error": "invalid_json_response", "status_code": r.status_code, "text": r.text}
+            return {"ok": False, "error": "invalid_json_response", "status_code": r.status,
+                    "text": r.data.decode("utf-8", "replace")}
     except Exception as e:
         logger.exception("Telegram request failed: %s", e)
         return None
 
 
-def telegram_request_multipart(method: str, data: dict, files: dict, timeout=120):
+def telegram_request_multipart(method: str, data: dict, files: dict, timeout=(3.05, 120)):
     if not API_URL:
         logger.error("BOT_TOKEN is not set")
         return None
-    url = f"{API_URL}/{method}"
+    url = TG_METHOD_URLS.get(method) or f"{API_URL}/{method}"
     try:
-        r = requests.post(url, data=data, files=files, timeout=timeout)
+        r = TG_MEDIA_SESSION.post(url, data=data, files=files, timeout=timeout)
         if r.status_code != 200:
             logger.warning("Telegram multipart API returned %s: %s", r.status_code, r.text)
         try:
-            return r.json()
+            return orjson.loads(r.content)
         except Exception:
             return {"ok": False, "error": "invalid_json_response", "status_code": r.status_code, "text": r.text}
     except Exception as e:
@@ -198,18 +411,86 @@ def telegram_request_multipart(method: str, data: dict, files: dict, timeout=120
         return None
 
 
-def send_message(chat_id, text, reply_markup=None):
-    payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
+def markup_json(reply_markup):
+    # Telegram takes reply_markup as a JSON string; prebuilt keyboards are already serialized
+    if isinstance(reply_markup, str):
+        return reply_markup
+    return orjson.dumps(reply_markup).decode()
+
+
+# parse_mode is opt-in (html=True): plain texts skip Telegram's entity parsing and can't trip over a stray "&" or "<".
+def send_message(chat_id, text, reply_markup=None, html=False):
+    payload = {"chat_id": chat_id, "text": text}
+    if html:
+        payload["parse_mode"] = "HTML"
     if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
+        payload["reply_markup"] = markup_json(reply_markup)
     return telegram_request_json("sendMessage", payload)
 
 
+def prerender_message(text, reply_markup=None, html=False):
+    # encode everything except chat_id once; send_prerendered splices chat_id back in
+    payload = {"text": text}
+    if html:
+        payload["parse_mode"] = "HTML"
+    if reply_markup:
+        payload["reply_markup"] = markup_json(reply_markup)
+    return orjson.dumps(payload)[1:]  # drop the opening "{"
+
+
+def send_prerendered(chat_id, rendered):
+    return telegram_request_json("sendMessage", b'{"chat_id":%d,' % int(chat_id) + rendered)
+
+
+def edit_prerendered(chat_id, message_id, rendered):
+    # Menu transitions rewrite the message whose button was pressed: one call, no new bubble in the chat.
+    # Media messages have no text to edit, so those (or a message too old to edit) get a fresh message instead.
+    if message_id:
+        resp = telegram_request_json(
+            "editMessageText", b'{"chat_id":%d,"message_id":%d,' % (int(chat_id), int(message_id)) + rendered)
+        if resp and (resp.get("ok") or "not modified" in str(resp.get("description", ""))):
+            return resp
+    return send_prerendered(chat_id, rendered)
+
+
+def send_media_group(chat_id, media):
+    # media: list of InputMedia dicts ({"type": "photo"|"video"|"document", "media": url_or_file_id, ...}), max 10
+    return telegram_request_json("sendMediaGroup", {"chat_id": chat_id, "media": media})
+
+
+# Fire-and-forget calls whose result nobody waits on (e.g. answerCallbackQuery), drained by SEND_WORKERS threads.
+# Past the soft limit, droppable calls are shed first so a backlog can't keep growing with low-value work.
+SEND_QUEUE = queue.Queue()
+SEND_QUEUE_SOFT_LIMIT = 500
+SEND_STATS = {"dropped": 0}
+
+
+def send_worker():
+    while True:
+        method, payload = SEND_QUEUE.get()
+        telegram_request_json(method, payload)
+
+
+def send_later(method, payload, droppable=False):
+    if droppable and SEND_QUEUE.qsize() > SEND_QUEUE_SOFT_LIMIT:
+        SEND_STATS["dropped"] += 1
+        return
+    SEND_QUEUE.put((method, payload))
+
+
+for _ in range(SEND_WORKERS):
+    threading.Thread(target=send_worker, name="send-worker", daemon=True).start()
+
+
 def answer_callback(cq_id):
-    telegram_request_json("answerCallbackQuery", {"callback_query_id": cq_id})
+    # don't hold up the handler on the spinner ack; it's cosmetic, so it's the first thing shed under load
+    send_later("answerCallbackQuery", {"callback_query_id": cq_id}, droppable=True)
 
 
 # ---------------- Keyboards ----------------
+BACK_ROW = [{"text": "🔙 Back", "callback_data": "back"}]
+
+
 def main_menu():
     return {
         "inline_keyboard": [
@@ -222,12 +503,8 @@ def main_menu():
 
 
 def packs_keyboard(p_type):
-    kb = []
-    for p in PACKS.values():
-        if p["type"] == p_type:
-            kb.append([{"text": p["title"], "callback_data": f"pack:{p['id']}"}])
-    kb.append([{"text": "🔙 Back", "callback_data": "back"}])
-    return {"inline_keyboard": kb}
+    kb = [[{"text": p["title"], "callback_data": f"pack:{p['id']}"}] for p in PACKS_BY_TYPE.get(p_type, ())]
+    return {"inline_keyboard": kb + [BACK_ROW]}
 
 
 def pack_actions(pack_id):
@@ -236,160 +513,265 @@ def pack_actions(pack_id):
         "inline_keyboard": [
             [{"text": "📤 Demo Preview", "callback_data": f"demo_pack:{pack_id}"}],
             [{"text": "💳 Buy", "callback_data": f"buy:{pack_id}"}],
-            [{"text": "🔙 Back", "callback_data": "back"}],
+            BACK_ROW,
         ]
     }
 
 
+# Per-order keyboards: cached already serialized, so re-sends (pay_now/retry/check) skip both build and dumps.
+@lru_cache(maxsize=1024)
 def payment_select_for_order(order_id):
-    return {
+    return markup_json({
         "inline_keyboard": [
             [{"text": "💰 Pay with Crypto", "callback_data": f"pay_now:{order_id}"}],
             [{"text": "❌ Cancel", "callback_data": f"cancel:{order_id}"}],
         ]
-    }
+    })
 
 
+@lru_cache(maxsize=1024)
 def invoice_kb(order_id):
-    return {
+    return markup_json({
         "inline_keyboard": [
             [{"text": "✅ I Paid (check)", "callback_data": f"check_paid:{order_id}"}],
             [{"text": "🔁 Retry / New Invoice", "callback_data": f"retry:{order_id}"}],
         ]
-    }
+    })
+
+
+@lru_cache(maxsize=1024)
+def resend_kb(order_id):
+    return markup_json({"inline_keyboard": [[{"text": "📦 Send my pack again", "callback_data": f"resend:{order_id}"}]]})
+
+
+# Static keyboards only depend on PACKS, so build and serialize them once.
+MAIN_MENU_KB = markup_json(main_menu())
+PACKS_KB_IMAGE = markup_json(packs_keyboard("image"))
+PACKS_KB_VIDEO = markup_json(packs_keyboard("video"))
+PACK_ACTIONS_KB = {pid: markup_json(pack_actions(pid)) for pid in PACKS}
+
+# Messages whose body never changes except for chat_id.
+START_MSG = prerender_message(f"👋 <b>Welcome to {APP_NAME}</b>\nChoose:", MAIN_MENU_KB, html=True)
+MAIN_MENU_MSG = prerender_message("Main menu:", MAIN_MENU_KB)
+IMAGE_PACKS_MSG = prerender_message("🖼 Image Packs:", PACKS_KB_IMAGE)
+VIDEO_PACKS_MSG = prerender_message("🎥 Video Packs:", PACKS_KB_VIDEO)
+ABOUT_MSG = prerender_message("🤖 Mythic AI Store\nAI-generated image & video packs.")
+WAIT_MSG = prerender_message("⏳ Wait a minute...")
+PRODUCT_NOT_FOUND_MSG = prerender_message("Product not found.")
+ORDER_NOT_FOUND_MSG = prerender_message("Order not found.")
+CANNOT_CANCEL_MSG = prerender_message("Order not found or cannot cancel.")
+BACK_TO_MENU_MSG = prerender_message("Returning to main menu.", MAIN_MENU_KB)
+NOT_DETECTED_MSG = prerender_message("Payment not detected yet. Please wait a few minutes and try again.")
+NO_ORDERS_MSG = prerender_message("You have no orders yet.")
+PACK_MSGS = {pid: prerender_message(p["caption"], PACK_ACTIONS_KB[pid], html=True) for pid, p in PACKS.items()}
 
 # ---------------- Utilities (DB) ----------------
+ORDERS_LIST_LIMIT = 20  # "orders" shows the most recent ones only
+
+# The order helpers below are single-row statements on the hot path: run them as Core statements
+# built once here (SQLAlchemy caches their compiled form), skipping ORM identity map / unit of work.
+# Built from the table rather than text() so the JSON columns keep their type processing.
+ORDERS = Order.__table__
+SQL_INSERT_ORDER = ORDERS.insert()
+SQL_GET_ORDER = select(ORDERS).where(ORDERS.c.order_id == bindparam("oid"))
+SQL_SET_INVOICE = ORDERS.update().where(ORDERS.c.order_id == bindparam("oid")).values(invoice=bindparam("inv"))
+SQL_CANCEL_ORDER = (ORDERS.update()
+                    .where(ORDERS.c.order_id == bindparam("oid"), ORDERS.c.user_id == bindparam("uid"),
+                           ORDERS.c.status == "pending")
+                    .values(status="cancelled"))
+SQL_MARK_PAID = (ORDERS.update()
+                 .where(ORDERS.c.order_id == bindparam("oid"), ORDERS.c.status != "paid")
+                 .values(status="paid", paid_at=bindparam("t"), tx_info=bindparam("tx"))
+                 .returning(ORDERS.c.user_id, ORDERS.c.product_id))
+
+
 def generate_order_id():
-    return f"ORD{int(time.time() * 1000)}"
+    # random suffix keeps ids unique when two buys land in the same millisecond on different workers
+    return f"ORD{int(time.time() * 1000)}{token_hex(4)}"
 
 
 def create_order_db(user_id, pack_id):
-    session = SessionLocal()
+    order = {
+        "order_id": generate_order_id(),
+        "user_id": int(user_id),
+        "product_id": pack_id,
+        "price": float(PRICES.get(pack_id, 1.0)),
+        "currency": "USDT",
+        "status": "pending",
+        "created_at": int(time.time()),
+        "invoice": None,
+    }
     try:
-        order_id = generate_order_id()
-        price = float(PRICES.get(pack_id, 1.0))
-        created_at = int(time.time())
-        o = Order(
-            order_id=order_id,
-            user_id=int(user_id),
-            product_id=pack_id,
-            price=price,
-            currency="USDT",
-            status="pending",
-            invoice=None,
-            created_at=created_at,
-            paid_at=None,
-            tx_info=None,
-        )
-        session.add(o)
-        session.commit()
-        session.refresh(o)
-        return {
-            "order_id": o.order_id,
-            "user_id": o.user_id,
-            "product_id": o.product_id,
-            "price": o.price,
-            "currency": o.currency,
-            "status": o.status,
-            "created_at": o.created_at,
-            "invoice": o.invoice,
-        }
+        with engine.begin() as conn:
+            conn.execute(SQL_INSERT_ORDER, {"paid_at": None, "tx_info": None, **order})
+        return order
     except Exception:
-        session.rollback()
         logger.exception("Failed to create order in DB")
         raise
-    finally:
-        session.close()
 
 
-def get_order_db(order_id):
-    session = SessionLocal()
-    try:
-        o = session.query(Order).filter_by(order_id=order_id).first()
-        if not o:
-            return None
-        return {
-            "order_id": o.order_id,
-            "user_id": o.user_id,
-            "product_id": o.product_id,
-            "price": o.price,
-            "currency": o.currency,
-            "status": o.status,
-            "invoice": o.invoice,
-            "created_at": o.created_at,
-            "paid_at": o.paid_at,
-            "tx_info": o.tx_info,
-        }
-    finally:
-        session.close()
+# A checkout re-reads the same order on every button press (pay_now, retry, check_paid, IPN).
+# Keep recent rows in-process for a few seconds; every write below drops the entry.
+ORDER_CACHE = OrderedDict()  # order_id -> (expires_at, order dict)
+ORDER_CACHE_LOCK = threading.Lock()
+ORDER_CACHE_MAX = 4096
+ORDER_CACHE_TTL = 30
 
 
-def list_user_orders_db(user_id):
-    session = SessionLocal()
-    try:
-        rows = session.query(Order).filter_by(user_id=int(user_id)).order_by(Order.created_at.desc()).all()
-        res = []
-        for o in rows:
-            res.append({
-                "order_id": o.order_id,
-                "product_id": o.product_id,
-                "price": o.price,
-                "currency": o.currency,
-                "status": o.status,
-                "created_at": o.created_at,
-                "paid_at": o.paid_at
-            })
-        return res
-    finally:
-        session.close()
+def invalidate_order(order_id):
+    with ORDER_CACHE_LOCK:
+        ORDER_CACHE.pop(order_id, None)
+
+
+def get_order_db(order_id, fresh=False):
+    # fresh=True skips the cache, for decisions another worker process may just have changed (payment status)
+    now = time.time()
+    if not fresh:
+        with ORDER_CACHE_LOCK:
+            hit = ORDER_CACHE.get(order_id)
+        if hit and hit[0] > now:
+            return dict(hit[1])
+    order = load_order_db(order_id)
+    if order:
+        with ORDER_CACHE_LOCK:
+            ORDER_CACHE[order_id] = (now + ORDER_CACHE_TTL, order)
+            ORDER_CACHE.move_to_end(order_id)
+            while len(ORDER_CACHE) > ORDER_CACHE_MAX:
+                ORDER_CACHE.popitem(last=False)
+        return dict(order)
+    return None
+
+
+def load_order_db(order_id):
+    with engine.connect() as conn:
+        row = conn.execute(SQL_GET_ORDER, {"oid": order_id}).mappings().first()
+    return dict(row) if row else None
+
+
+# Columns the "orders" listing shows; skips the invoice/tx_info JSON blobs.
+ORDER_LIST_COLS = (Order.order_id, Order.product_id, Order.price, Order.currency, Order.status,
+                   Order.created_at, Order.paid_at)
+ORDER_LIST_KEYS = tuple(c.key for c in ORDER_LIST_COLS)
+
+
+def list_user_orders_db(user_id, limit=ORDERS_LIST_LIMIT):
+    stmt = (select(*ORDER_LIST_COLS).where(Order.user_id == int(user_id))
+            .order_by(Order.created_at.desc()).limit(limit))
+    with engine.connect() as conn:
+        return [dict(zip(ORDER_LIST_KEYS, row)) for row in conn.execute(stmt)]
 
 
 def update_order_invoice_db(order_id, invoice_obj):
-    session = SessionLocal()
     try:
-        o = session.query(Order).filter_by(order_id=order_id).first()
-        if not o:
-            return None
-        o.invoice = invoice_obj
-        session.commit()
-        return True
+        with engine.begin() as conn:
+            updated = conn.execute(SQL_SET_INVOICE, {"oid": order_id, "inv": invoice_obj}).rowcount
+        invalidate_order(order_id)
+        return True if updated else None
     except Exception:
-        session.rollback()
         logger.exception("Failed to update invoice")
         return False
-    finally:
-        session.close()
+
+
+def cancel_order_db(order_id, user_id):
+    # single conditional UPDATE: only the owner can cancel, and only while pending
+    try:
+        with engine.begin() as conn:
+            updated = conn.execute(SQL_CANCEL_ORDER, {"oid": order_id, "uid": int(user_id)}).rowcount
+        if updated:
+            invalidate_order(order_id)
+        return bool(updated)
+    except Exception:
+        logger.exception("Failed to cancel order")
+        return False
 
 
 def mark_order_paid_db(order_id, tx_info=None):
-    session = SessionLocal()
+    """
+    Mark an order paid and queue its delivery. Idempotent: the UPDATE only matches orders not yet paid,
+    so a repeated IPN or check doesn't deliver twice. Returns True only when this call marked it.
+    Delivery (a Drive download + upload, possibly seconds) runs on the delivery workers so the
+    NowPayments webhook is answered right after the UPDATE.
+    """
     try:
-        o = session.query(Order).filter_by(order_id=order_id).first()
-        if not o:
-            return False
-        o.status = "paid"
-        o.paid_at = int(time.time())
-        o.tx_info = tx_info
-        session.commit()
-        # attempt delivery (use try_send_demo_media to handle Drive links robustly)
-        try:
-            chat_id = o.user_id
-            product = PACKS.get(o.product_id)
-            if product:
-                try_send_demo_media(chat_id, product.get("deliver_url"), caption=f"Here is your pack: {product.get('title')}")
-            else:
-                send_message(chat_id, "✅ Payment confirmed. Your file is ready.")
-        except Exception:
-            logger.exception("Failed to deliver file after marking paid")
-        return True
+        with engine.begin() as conn:
+            # one round trip: the guarded UPDATE hands back what delivery needs
+            row = conn.execute(SQL_MARK_PAID, {"oid": order_id, "t": int(time.time()), "tx": tx_info}).first()
     except Exception:
-        session.rollback()
         logger.exception("Failed to mark order paid")
         return False
-    finally:
-        session.close()
+    if row is None:
+        return False
+    invalidate_order(order_id)
+    queue_delivery(row.user_id, row.product_id, order_id)
+    return True
+
+
+def deliver_order(user_id, product_id, order_id):
+    # uses try_send_demo_media to handle Drive links robustly
+    try:
+        product = PACKS.get(product_id)
+        if product:
+            # confirmation and pack go out as one captioned upload
+            caption = f"✅ Payment confirmed for order {order_id}.\nHere is your pack: {product.get('title')}"
+            urls = product.get("deliver_urls") or [product.get("deliver_url")]
+            sent = send_cached_group(user_id, urls, caption=caption) if len(urls) > 1 else 0
+            # whatever isn't cached yet goes one by one (and gets cached for the next buyer)
+            for i, url in enumerate(urls[sent:]):
+                try_send_demo_media(user_id, url, caption=caption if sent == 0 and i == 0 else None)
+        else:
+            send_message(user_id, "✅ Payment confirmed. Your file is ready.")
+    except Exception:
+        logger.exception("Failed to deliver order %s", order_id)
+
+
+def claim_webhook_db(key):
+    """Record an IPN key; False if it was already processed (duplicate delivery)."""
+    try:
+        with SessionLocal.begin() as session:
+            session.add(ProcessedWebhook(key=key, received_at=int(time.time())))
+        return True
+    except IntegrityError:
+        return False
+    except Exception:
+        # don't drop a payment because the dedupe bookkeeping failed
+        logger.exception("Failed to record webhook key %s", key)
+        return True
+
+
+def get_media_file_db(url):
+    with SessionLocal() as session:
+        m = session.get(MediaFile, url)
+        if not m:
+            return None
+        return m.kind, m.file_id
+
+
+def save_media_file_db(url, kind, file_id):
+    try:
+        with SessionLocal.begin() as session:
+            session.merge(MediaFile(url=url, kind=kind, file_id=file_id, created_at=int(time.time())))
+        return True
+    except Exception:
+        logger.exception("Failed to save media file_id")
+        return False
+
+
+def delete_media_file_db(url):
+    try:
+        with SessionLocal.begin() as session:
+            session.query(MediaFile).filter_by(url=url).delete(synchronize_session=False)
+    except Exception:
+        logger.exception("Failed to delete media file_id")
 
 # ---------------- NowPayments integration ----------------
+NP_SESSION = requests.Session()
+NP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+
 def create_invoice_nowpayments_db(order):
     if not NOWPAYMENTS_API_KEY:
         fake = {
@@ -412,9 +794,9 @@ def create_invoice_nowpayments_db(order):
         "ipn_callback_url": f"{PUBLIC_URL}/nowpayments_webhook",
     }
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=15)
+        r = NP_SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=15)
         r.raise_for_status()
-        data = r.json()
+        data = orjson.loads(r.content)
         update_order_invoice_db(order["order_id"], data)
         return data
     except Exception:
@@ -429,6 +811,27 @@ def create_invoice_nowpayments_db(order):
         update_order_invoice_db(order["order_id"], fake)
         return fake
 
+
+NP_POLL_TTL = 30  # seconds a polled payment status is reused for repeated "I Paid" presses
+
+
+@lru_cache(maxsize=256)
+def _nowpayments_payment_status(payment_id, _bucket):
+    # errors propagate: lru_cache doesn't store them, so a failed poll is retried on the next press
+    r = NP_SESSION.get(f"https://api.nowpayments.io/v1/payment/{payment_id}",
+                       headers={"x-api-key": NOWPAYMENTS_API_KEY}, timeout=10)
+    r.raise_for_status()
+    return orjson.loads(r.content).get("payment_status")
+
+
+def nowpayments_payment_status(payment_id):
+    # _bucket changes every NP_POLL_TTL seconds, so cached answers expire with it
+    try:
+        return _nowpayments_payment_status(str(payment_id), int(time.time() // NP_POLL_TTL))
+    except Exception:
+        logger.exception("NowPayments status poll failed for payment %s", payment_id)
+        return None
+
 # ---------------- Image helpers ----------------
 def compress_image_to_jpeg_bytes(img_bytes, target_bytes=10 * 1024 * 1024):
     """
@@ -473,7 +876,137 @@ def compress_image_to_jpeg_bytes(img_bytes, target_bytes=10 * 1024 * 1024):
         logger.exception("compress_image_to_jpeg_bytes failed")
         return None, None
 
+# ---------------- Telegram file_id cache ----------------
+# Once a URL has been uploaded, Telegram hands back a file_id that can be re-sent without
+# downloading from Drive or uploading again. In-process dict in front of the media_files table.
+# keyed by the kind Telegram filed the upload as, which is not always the kind we asked for
+MEDIA_METHODS = {"photo": "sendPhoto", "video": "sendVideo", "animation": "sendAnimation", "document": "sendDocument"}
+MEDIA_FILE_IDS = {}
+
+
+def get_media_file_id(url):
+    cached = MEDIA_FILE_IDS.get(url)
+    if cached is None:
+        cached = get_media_file_db(url)
+        if cached:
+            MEDIA_FILE_IDS[url] = cached
+    return cached
+
+
+def remember_media_file_id(url, kind, file_id):
+    MEDIA_FILE_IDS[url] = (kind, file_id)
+    save_media_file_db(url, kind, file_id)
+
+
+# Telegram error descriptions that mean the file_id itself is unusable (vs. chat/rights/caption problems);
+# a type mismatch covers rows cached under the requested kind rather than the one Telegram returned
+STALE_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference expired",
+                        "invalid file", "file_id", "type of file mismatch", "file type mismatch")
+
+
+def is_stale_file_id_error(resp):
+    desc = str(resp.get("description") or "").lower()
+    return resp.get("error_code") == 400 and any(e in desc for e in STALE_FILE_ID_ERRORS)
+
+
+def forget_media_file_id(url):
+    MEDIA_FILE_IDS.pop(url, None)
+    delete_media_file_db(url)
+
+
+def extract_file_id(resp, kind):
+    """
+    (kind, file_id) as Telegram actually filed the upload, or None. A video may come back as an
+    animation or a document, and its file_id only works with the matching send method.
+    """
+    result = (resp or {}).get("result") or {}
+    if kind == "photo":
+        sizes = result.get("photo") or []
+        return ("photo", sizes[-1].get("file_id")) if sizes else None  # largest size is last
+    # animations also carry a "document" field, so check the more specific kinds first
+    for got in (kind, "animation", "document"):
+        file_id = (result.get(got) or {}).get("file_id")
+        if file_id:
+            return got, file_id
+    return None
+
+
+def media_payload(chat_id, kind, media, caption=None, reply_markup=None):
+    # JSON body for sendPhoto/sendVideo/sendDocument where media is a file_id or URL
+    payload = {"chat_id": chat_id, kind: media}
+    if caption:
+        payload["caption"] = caption
+        payload["parse_mode"] = "HTML"
+    if reply_markup:
+        payload["reply_markup"] = markup_json(reply_markup)
+    return payload
+
+
+def send_cached_media(chat_id, media_url, caption=None, reply_markup=None):
+    """
+    Re-send previously uploaded media by file_id.
+    Returns the Telegram response (errors included), or None on a cache miss / stale file_id /
+    transport failure so the caller uploads instead.
+    """
+    cached = get_media_file_id(media_url)
+    if not cached:
+        return None
+    kind, file_id = cached
+    resp = telegram_request_json(MEDIA_METHODS[kind], media_payload(chat_id, kind, file_id, caption, reply_markup))
+    if not resp or resp.get("ok"):
+        return resp
+    if is_stale_file_id_error(resp):
+        # drop it so the upload below refreshes it
+        logger.warning("Cached file_id rejected for %s: %s", media_url, resp.get("description"))
+        forget_media_file_id(media_url)
+        return None
+    # chat not found, no rights, caption too long, ...: a re-upload would fail the same way
+    return resp
+
+
+def send_cached_group(chat_id, urls, caption=None):
+    """
+    Send previously uploaded files as albums (sendMediaGroup, 10 per call) instead of one call per file.
+    Returns how many of urls went out; 0 when any of them isn't cached yet or the kinds can't share an album.
+    """
+    cached = [get_media_file_id(url) for url in urls]
+    if not all(cached):
+        return 0
+    kinds = {kind for kind, _ in cached}
+    if "animation" in kinds:
+        return 0  # sendMediaGroup has no animation type; these go one by one
+    if "document" in kinds and len(kinds) > 1:
+        return 0  # documents can only be grouped with documents
+    media = [{"type": kind, "media": file_id} for kind, file_id in cached]
+    if caption:
+        media[0]["caption"] = caption
+        media[0]["parse_mode"] = "HTML"
+    sent = 0
+    for i in range(0, len(media), 10):
+        resp = send_media_group(chat_id, media[i:i + 10])
+        if not (resp and resp.get("ok")):
+            break
+        sent = min(i + 10, len(media))
+    return sent
+
+
+def upload_media(media_url, kind, data, files):
+    resp = telegram_request_multipart(MEDIA_METHODS[kind], data, files)
+    filed = extract_file_id(resp, kind)
+    if filed:
+        remember_media_file_id(media_url, *filed)
+    return resp
+
 # ---------------- Demo helpers & robust sender ----------------
+# Drive downloads are slow and large; keep them off the Telegram/NowPayments pools.
+DRIVE_SESSION = requests.Session()
+DRIVE_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+
 def user_can_request_demo(user_id):
     last = DEMO_USAGE.get(int(user_id))
     if not last:
@@ -485,69 +1018,434 @@ def user_can_request_demo(user_id):
 
 
 def record_demo_usage(user_id):
-    DEMO_USAGE[int(user_id)] = int(time.time())
+    now = int(time.time())
+    with DEMO_USAGE_LOCK:
+        DEMO_USAGE[int(user_id)] = now
+        DEMO_USAGE.move_to_end(int(user_id))
+        # drop entries whose cooldown has expired (they no longer matter), then enforce the hard cap
+        while DEMO_USAGE:
+            last = next(iter(DEMO_USAGE.values()))
+            if now - last < DEMO_COOLDOWN_SECONDS and len(DEMO_USAGE) <= DEMO_USAGE_MAX:
+                break
+            DEMO_USAGE.popitem(last=False)
+
+
+# url -> (content_type, size_or_None), filled by a one-off HEAD probe at startup
+MEDIA_INFO = {}
+
+
+def probe_media(url):
+    try:
+        r = DRIVE_SESSION.head(url, allow_redirects=True, timeout=(3.05, 10))
+        ctype = (r.headers.get("Content-Type") or "").lower()
+        length = r.headers.get("Content-Length")
+        # Drive answers large files with an HTML interstitial; that tells us nothing about the file
+        if r.ok and not ctype.startswith("text/html"):
+            MEDIA_INFO[url] = (ctype, int(length) if length and length.isdigit() else None)
+    except Exception:
+        logger.warning("HEAD probe failed for %s", url)
+
+
+def all_media_urls():
+    urls = set(DEMO_POOL)
+    for p in PACKS.values():
+        urls.update(u for u in (p.get("demo_url"), p.get("deliver_url"), *p.get("deliver_urls", ())) if u)
+    return urls
+
+
+# Drive ids the /media proxy will serve; anything else is refused so it can't be used as an open proxy.
+MEDIA_DRIVE_IDS = frozenset(filter(None, map(drive_file_id, all_media_urls())))
+PROXY_ENABLED = PUBLIC_URL != "https://example.com"
+MAX_URL_PHOTO = 5 * 1024 * 1024      # Telegram's limit for photos sent by URL
+MAX_URL_OTHER = 20 * 1024 * 1024     # ... and for other files sent by URL
+URL_DOCUMENT_TYPES = frozenset(("application/pdf", "application/zip"))  # only these work as documents by URL
+
+
+def probe_all_media():
+    urls = all_media_urls()
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(probe_media, urls))
+    logger.info("Probed %d/%d media URLs", len(MEDIA_INFO), len(urls))
+
+
+def send_via_proxy(chat_id, media_url, caption=None, reply_markup=None):
+    """
+    Let Telegram fetch probed Drive media through our /media proxy, which serves the real
+    content-type instead of Drive's download page. Saves downloading and re-uploading here.
+    Returns the Telegram response, or None when not applicable / rejected so the caller uploads instead.
+    """
+    fid = drive_file_id(media_url)
+    info = MEDIA_INFO.get(media_url)
+    if not PROXY_ENABLED or not fid or not info or info[1] is None:
+        return None
+    ctype, size = info
+    if ctype.startswith("image/") and size <= MAX_URL_PHOTO:
+        kind = "photo"
+    elif ctype.startswith("video/") and size <= MAX_URL_OTHER:
+        kind = "video"
+    elif ctype.split(";")[0].strip() in URL_DOCUMENT_TYPES and size <= MAX_URL_OTHER:
+        kind = "document"
+    else:
+        return None
+    resp = telegram_request_json(MEDIA_METHODS[kind], media_payload(chat_id, kind, f"{PUBLIC_URL}/media/{fid}", caption, reply_markup))
+    if not (resp and resp.get("ok")):
+        return None
+    filed = extract_file_id(resp, kind)
+    if filed:
+        remember_media_file_id(media_url, *filed)
+    return resp
+
+
+def download_capped(media_url, max_bytes):
+    """
+    Stream a download in 1 MB chunks, giving up as soon as it is known to exceed max_bytes
+    (from Content-Length when present, otherwise while reading).
+    Returns (content, content_type); content is None when the file is too large.
+    """
+    with DRIVE_SESSION.get(media_url, timeout=(3.05, 60), stream=True) as r:
+        r.raise_for_status()
+        ctype = (r.headers.get("Content-Type") or "").lower()
+        length = r.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            return None, ctype
+        chunks = []
+        size = 0
+        for chunk in r.iter_content(1 << 20):
+            size += len(chunk)
+            if size > max_bytes:
+                return None, ctype
+            chunks.append(chunk)
+        return b"".join(chunks), ctype
+
+
+@lru_cache(maxsize=256)
+def url_media_kind(url):
+    # extension-based hint for URLs whose Content-Type is missing or generic; the URL set is fixed, so cache it
+    lowered = url.lower()
+    if lowered.endswith((".mp4", ".mov", ".webm", ".mkv")):
+        return "video"
+    if lowered.endswith((".jpg", ".jpeg", ".png", ".webp")):
+        return "photo"
+    return None
 
 
 def try_send_demo_media(chat_id, media_url, caption=None, reply_markup=None):
     """
-    Download file, inspect Content-Type and size, and upload to Telegram accordingly.
+    Send by cached Telegram file_id when this URL was uploaded before; otherwise
+    download file, inspect Content-Type and size, and upload to Telegram accordingly.
     Prioritize:
       - if video -> sendVideo multipart (<=50MB)
       - if image -> try to compress to <=10MB and sendPhoto multipart; if fails sendDocument
       - otherwise -> sendDocument multipart (<=50MB)
     Fallback: send text message with link.
     """
+    resp = send_cached_media(chat_id, media_url, caption=caption, reply_markup=reply_markup) \
+        or send_via_proxy(chat_id, media_url, caption=caption, reply_markup=reply_markup)
+    if resp:
+        return resp
     try:
-        r = requests.get(media_url, timeout=60, stream=True)
-        r.raise_for_status()
-        content = r.content
-        size = len(content)
-        ctype = (r.headers.get("Content-Type") or "").lower()
-
         max_photo = 10 * 1024 * 1024
         max_telegram = 50 * 1024 * 1024
 
-        if size > max_telegram:
+        probed_ctype, probed_size = MEDIA_INFO.get(media_url, ("", None))
+        content = None
+        if probed_size is None or probed_size <= max_telegram:
+            content, ctype = download_capped(media_url, max_telegram)
+        if content is None:
             return send_message(chat_id, f"The file is too large for Telegram to upload.\n\n{media_url}")
+        size = len(content)
+        if not ctype or ctype == "application/octet-stream":
+            ctype = probed_ctype or ctype
 
         data = {"chat_id": str(chat_id)}
         if caption:
             data["caption"] = caption
             data["parse_mode"] = "HTML"
         if reply_markup:
-            data["reply_markup"] = json.dumps(reply_markup)
+            data["reply_markup"] = markup_json(reply_markup)
 
         # VIDEO detection
-        if "video" in ctype or media_url.lower().endswith((".mp4", ".mov", ".webm", ".mkv")):
+        url_kind = url_media_kind(media_url)
+        if "video" in ctype or url_kind == "video":
             files = {"video": ("file.mp4", BytesIO(content), ctype or "video/mp4")}
-            return telegram_request_multipart("sendVideo", data, files)
+            return upload_media(media_url, "video", data, files)
 
         # IMAGE detection
-        if "image" in ctype or media_url.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+        if "image" in ctype or url_kind == "photo":
             # if small enough already -> sendPhoto multipart
             if size <= max_photo:
                 files = {"photo": ("file.jpg", BytesIO(content), ctype or "image/jpeg")}
-                return telegram_request_multipart("sendPhoto", data, files)
+                return upload_media(media_url, "photo", data, files)
 
             # try compress/convert to JPEG under limit
             compressed_bytes, out_ctype = compress_image_to_jpeg_bytes(content, target_bytes=max_photo)
             if compressed_bytes:
                 files = {"photo": ("file.jpg", BytesIO(compressed_bytes), out_ctype)}
-                return telegram_request_multipart("sendPhoto", data, files)
+                return upload_media(media_url, "photo", data, files)
 
             # fallback to sending as document if compression fails
             files = {"document": ("file", BytesIO(content), ctype or "application/octet-stream")}
-            return telegram_request_multipart("sendDocument", data, files)
+            return upload_media(media_url, "document", data, files)
 
         # OTHERWISE: send as document
         files = {"document": ("file", BytesIO(content), ctype or "application/octet-stream")}
-        return telegram_request_multipart("sendDocument", data, files)
+        return upload_media(media_url, "document", data, files)
 
     except Exception:
         logger.exception("try_send_demo_media failed")
-        return send_message(chat_id, (caption or "Demo") + "\n\n" + media_url, reply_markup=reply_markup)
+        # caption may carry markup (pack captions), so the URL's "&"s need escaping
+        return send_message(chat_id, (caption or "Demo") + "\n\n" + escape(media_url), reply_markup=reply_markup,
+                            html=True)
+
+
+def warm_media(url):
+    # upload once to the warmup chat so real users get the cached file_id, then tidy the chat up
+    if get_media_file_id(url):
+        return
+    resp = try_send_demo_media(WARMUP_CHAT_ID, url)
+    message_id = ((resp or {}).get("result") or {}).get("message_id")
+    if message_id:
+        telegram_request_json("deleteMessage", {"chat_id": WARMUP_CHAT_ID, "message_id": message_id})
+
+
+def warm_demo_media():
+    urls = set(DEMO_POOL)
+    urls.update(p["demo_url"] for p in PACKS.values() if p.get("demo_url"))
+    if not urls:
+        return
+    with ThreadPoolExecutor(max_workers=min(WARMUP_WORKERS, len(urls))) as ex:
+        list(ex.map(warm_media, urls))
+    logger.info("Warmed file_id cache for %d demo URLs", len(urls))
+
+
+def prepare_media():
+    probe_all_media()
+    if WARMUP_CHAT_ID and API_URL:
+        warm_demo_media()
+
+
+# Learn media types/sizes and pre-upload demos in the background so startup isn't held up
+# (MEDIA_PROBE=0 disables both, e.g. in CI).
+if os.getenv("MEDIA_PROBE", "1") == "1":
+    threading.Thread(target=prepare_media, name="media-probe", daemon=True).start()
 
 # ---------------- Core Logic ----------------
+# Callback handlers take (chat_id, arg, message_id): arg is the part of callback_data after the first ":",
+# message_id is the message carrying the pressed button (menu handlers edit it in place).
+def cb_images(chat_id, arg, message_id):
+    edit_prerendered(chat_id, message_id, IMAGE_PACKS_MSG)
+
+
+def cb_videos(chat_id, arg, message_id):
+    edit_prerendered(chat_id, message_id, VIDEO_PACKS_MSG)
+
+
+def cb_demo(chat_id, arg, message_id):
+    allowed, seconds_left = user_can_request_demo(chat_id)
+    if not allowed:
+        hours = int(seconds_left // 3600)
+        mins = int((seconds_left % 3600) // 60)
+        if hours >= 1:
+            send_message(chat_id, f"You've recently used Demo. Please try again in {hours} hour(s) and {mins} minute(s).")
+        else:
+            send_message(chat_id, f"You've recently used Demo. Please try again in {mins} minute(s).")
+        return
+
+    if not DEMO_POOL:
+        first = next(iter(PACKS.values()))
+        try_send_demo_media(chat_id, first.get("demo_url") or DEFAULT_DEMO_IMAGE, caption="🎁 Demo — enjoy!")
+        record_demo_usage(chat_id)
+        return
+
+    media_url = random.choice(DEMO_POOL)
+    try_send_demo_media(chat_id, media_url, caption="🎁 Demo — enjoy!")
+    record_demo_usage(chat_id)
+
+
+def cb_about(chat_id, arg, message_id):
+    send_prerendered(chat_id, ABOUT_MSG)
+
+
+def cb_back(chat_id, arg, message_id):
+    edit_prerendered(chat_id, message_id, MAIN_MENU_MSG)
+
+
+def cb_pack(chat_id, pid, message_id):
+    # when user presses a pack -> show title/description + actions (with Demo Preview)
+    rendered = PACK_MSGS.get(pid)
+    if rendered:
+        edit_prerendered(chat_id, message_id, rendered)
+
+
+def cb_demo_pack(chat_id, pid, message_id):
+    # demo preview for the pack (explicit) - show wait message then send
+    p = PACKS.get(pid)
+    if not p:
+        send_prerendered(chat_id, PRODUCT_NOT_FOUND_MSG)
+        return
+    # send wait message first
+    send_prerendered(chat_id, WAIT_MSG)
+    # send the demo media (will handle image/video properly)
+    try_send_demo_media(chat_id, p["demo_media"], caption=p["caption"], reply_markup=PACK_ACTIONS_KB[pid])
+
+
+def cb_buy(chat_id, pid, message_id):
+    # BUY flow: create order in DB then show payment buttons (Pay with Crypto)
+    if pid not in PACKS:
+        send_prerendered(chat_id, PRODUCT_NOT_FOUND_MSG)
+        return
+    order = create_order_db(chat_id, pid)
+    send_message(
+        chat_id,
+        f"🧾 Order created: <b>{order['order_id']}</b>\nProduct: {pid}\nPrice: {order['price']} {order['currency']}\n\nChoose payment method:",
+        reply_markup=payment_select_for_order(order["order_id"]),
+        html=True,
+    )
+
+
+def cb_cancel(chat_id, oid, message_id):
+    # cancel (works for either order or pack callbacks)
+    if cancel_order_db(oid, chat_id):
+        send_message(chat_id, f"Order {oid} cancelled.")
+        return
+    # nothing cancelled: only now look the order up to pick the right reply
+    o = get_order_db(oid)
+    if o and o["user_id"] == chat_id:
+        send_prerendered(chat_id, CANNOT_CANCEL_MSG)
+    else:
+        send_prerendered(chat_id, BACK_TO_MENU_MSG)
+
+
+def cb_pay_now(chat_id, oid, message_id):
+    # pay_now -> create invoice with NowPayments and return pay_url (no currency selection)
+    order = get_order_db(oid)
+    if not order:
+        send_prerendered(chat_id, ORDER_NOT_FOUND_MSG)
+        return
+    invoice = create_invoice_nowpayments_db(order)
+    pay_url = invoice.get("pay_url") or invoice.get("invoice_url") or invoice.get("url") or f"{PUBLIC_URL}/pay/{oid}"
+    send_message(
+        chat_id,
+        f"Invoice created.\n\nPay here: {escape(pay_url)}\n\nAfter payment press <b>I Paid (check)</b>.",
+        reply_markup=invoice_kb(oid),
+        html=True,
+    )
+
+
+def cb_retry(chat_id, oid, message_id):
+    # retry -> new invoice for the same order
+    order = get_order_db(oid)
+    if not order:
+        send_prerendered(chat_id, ORDER_NOT_FOUND_MSG)
+        return
+    invoice = create_invoice_nowpayments_db(order)
+    pay_url = invoice.get("pay_url") or invoice.get("invoice_url") or invoice.get("url") or f"{PUBLIC_URL}/pay/{oid}"
+    send_message(chat_id, f"New invoice: {pay_url}", reply_markup=invoice_kb(oid))
+
+
+def confirm_paid(chat_id, oid, tx_info):
+    if mark_order_paid_db(oid, tx_info=tx_info):
+        send_prerendered(chat_id, WAIT_MSG)  # delivery is queued; its caption confirms the payment
+    else:
+        # an IPN or another worker got there first (its delivery is already under way)
+        send_message(chat_id, f"✅ Payment already confirmed for order {oid}. Your pack is on its way.")
+
+
+def cb_check_paid(chat_id, oid, message_id):
+    # check_paid -> manual verification: if DB shows paid or invoice.status == paid, deliver
+    o = get_order_db(oid, fresh=True)
+    if not o:
+        send_prerendered(chat_id, ORDER_NOT_FOUND_MSG)
+        return
+    invoice = o.get("invoice") or {}
+    if o["status"] == "paid":
+        # already delivered: re-sending is an explicit button, not a side effect of every "I Paid" press
+        send_message(chat_id, f"✅ Order {oid} is already paid and delivered.", resend_kb(oid))
+    elif isinstance(invoice, dict) and invoice.get("status") == "paid":
+        confirm_paid(chat_id, oid, invoice)
+    else:
+        # the IPN may be late or lost: ask NowPayments directly once a payment exists for this order
+        payment_id = invoice.get("payment_id") if isinstance(invoice, dict) else None
+        status = nowpayments_payment_status(payment_id) if payment_id and NOWPAYMENTS_API_KEY else None
+        if status in NP_PAID_PAYMENT_STATUSES:
+            confirm_paid(chat_id, oid, {"payment_id": payment_id, "payment_status": status})
+        else:
+            send_prerendered(chat_id, NOT_DETECTED_MSG)
+
+
+def cb_resend(chat_id, oid, message_id):
+    # resend -> re-deliver a paid order's pack to its buyer, off the update workers
+    o = get_order_db(oid)
+    if not o or o["user_id"] != chat_id:
+        send_prerendered(chat_id, ORDER_NOT_FOUND_MSG)
+        return
+    if o["status"] != "paid":
+        send_prerendered(chat_id, NOT_DETECTED_MSG)
+        return
+    send_prerendered(chat_id, WAIT_MSG)
+    queue_delivery(o["user_id"], o["product_id"], oid)
+
+
+# callback_data prefix (text before the first ":") -> handler
+CALLBACK_HANDLERS = {
+    "images": cb_images,
+    "videos": cb_videos,
+    "demo": cb_demo,
+    "about": cb_about,
+    "back": cb_back,
+    "pack": cb_pack,
+    "demo_pack": cb_demo_pack,
+    "buy": cb_buy,
+    "cancel": cb_cancel,
+    "pay_now": cb_pay_now,
+    "retry": cb_retry,
+    "check_paid": cb_check_paid,
+    "resend": cb_resend,
+}
+
+
+def is_actionable_update(update):
+    # cheap structural check so noise (edits, stickers, malformed bodies) is acked without touching handlers
+    if not isinstance(update, dict):
+        return False
+    q = update.get("callback_query")
+    if q is not None:
+        return isinstance(q, dict) and isinstance(q.get("data"), str) and isinstance(q.get("message"), dict)
+    msg = update.get("message")
+    if not isinstance(msg, dict) or not isinstance(msg.get("chat"), dict):
+        return False
+    text = msg.get("text")
+    return isinstance(text, str) and (text.startswith("/") or text.lower().strip() == "orders")
+
+
+# (chat_id, message_id) -> (callback_data, monotonic time it was last handled). Pressing the same button
+# of the same message again within the window (button mashing) is acked but not handled; any other press
+# (A -> B -> A) goes through. Entries are kept in handled order, so expired ones are always at the front.
+RECENT_CALLBACKS = OrderedDict()
+RECENT_CALLBACKS_LOCK = threading.Lock()
+RECENT_CALLBACKS_MAX = 10000
+CALLBACK_DEDUPE_SECONDS = 0.5
+# Telegram drops a callback_query_id after ~15s; answering later is a guaranteed-to-fail round-trip
+CALLBACK_ANSWER_WINDOW = 14.0
+
+
+def is_repeat_callback(chat_id, message_id, data):
+    now = time.monotonic()
+    key = (chat_id, message_id)
+    with RECENT_CALLBACKS_LOCK:
+        while RECENT_CALLBACKS:
+            _, handled_at = next(iter(RECENT_CALLBACKS.values()))
+            if now - handled_at < CALLBACK_DEDUPE_SECONDS and len(RECENT_CALLBACKS) < RECENT_CALLBACKS_MAX:
+                break
+            RECENT_CALLBACKS.popitem(last=False)
+        last = RECENT_CALLBACKS.get(key)
+        if last is not None and last[0] == data:
+            return True
+        RECENT_CALLBACKS[key] = (data, now)
+        RECENT_CALLBACKS.move_to_end(key)
+    return False
+
+
 def handle_update(update):
     try:
         # message
@@ -555,15 +1453,17 @@ def handle_update(update):
             msg = update["message"]
             chat_id = msg["chat"]["id"]
             text = msg.get("text", "")
+            # "/start payload" and "/start@BotName" both reduce to "/start"
+            command = text.partition(" ")[0].partition("@")[0]
 
-            if text == "/start":
-                send_message(chat_id, f"👋 <b>Welcome to {APP_NAME}</b>\nChoose:", reply_markup=main_menu())
+            if command == "/start":
+                send_prerendered(chat_id, START_MSG)
                 return
 
             if text and text.lower().strip() == "orders":
                 user_orders = list_user_orders_db(chat_id)
                 if not user_orders:
-                    send_message(chat_id, "You have no orders yet.")
+                    send_prerendered(chat_id, NO_ORDERS_MSG)
                 else:
                     txt = "Your orders:\n\n"
                     for o in user_orders:
@@ -576,199 +1476,139 @@ def handle_update(update):
             q = update["callback_query"]
             data = q["data"]
             chat_id = q["message"]["chat"]["id"]
+            message_id = q["message"].get("message_id")
             cq_id = q["id"]
 
-            answer_callback(cq_id)
-
-            # main menu
-            if data == "images":
-                send_message(chat_id, "🖼 Image Packs:", reply_markup=packs_keyboard("image"))
-                return
-            if data == "videos":
-                send_message(chat_id, "🎥 Video Packs:", reply_markup=packs_keyboard("video"))
-                return
-
-            if data == "demo":
-                allowed, seconds_left = user_can_request_demo(chat_id)
-                if not allowed:
-                    hours = int(seconds_left // 3600)
-                    mins = int((seconds_left % 3600) // 60)
-                    if hours >= 1:
-                        send_message(chat_id, f"You've recently used Demo. Please try again in {hours} hour(s) and {mins} minute(s).")
-                    else:
-                        send_message(chat_id, f"You've recently used Demo. Please try again in {mins} minute(s).")
-                    return
-
-                if not DEMO_POOL:
-                    first = next(iter(PACKS.values()))
-                    try_send_demo_media(chat_id, first.get("demo_url") or DEFAULT_DEMO_IMAGE, caption="🎁 Demo — enjoy!")
-                    record_demo_usage(chat_id)
-                    return
-
-                media_url = random.choice(DEMO_POOL)
-                try_send_demo_media(chat_id, media_url, caption="🎁 Demo — enjoy!")
-                record_demo_usage(chat_id)
+            if time.monotonic() - update.get("_t0", time.monotonic()) < CALLBACK_ANSWER_WINDOW:
+                answer_callback(cq_id)
+            if is_repeat_callback(chat_id, message_id, data):
                 return
 
-            if data == "about":
-                send_message(chat_id, "🤖 Mythic AI Store\nAI-generated image & video packs.")
-                return
-            if data == "back":
-                send_message(chat_id, "Main menu:", reply_markup=main_menu())
-                return
-
-            # when user presses a pack -> show title/description + actions (with Demo Preview)
-            if data.startswith("pack:"):
-                pid = data.split(":", 1)[1]
-                p = PACKS.get(pid)
-                if p:
-                    caption = f"<b>{p['title']}</b>\n{p['description']}"
-                    send_message(chat_id, caption, reply_markup=pack_actions(pid))
-                return
-
-            # demo preview for the pack (explicit) - show wait message then send
-            if data.startswith("demo_pack:"):
-                pid = data.split(":", 1)[1]
-                p = PACKS.get(pid)
-                if not p:
-                    send_message(chat_id, "Product not found.")
-                    return
-                # send wait message first
-                send_message(chat_id, "⏳ Wait a minute...")
-                caption = f"<b>{p['title']}</b>\n{p['description']}"
-                # send the demo media (will handle image/video properly)
-                try_send_demo_media(chat_id, p.get("demo_url") or (DEFAULT_DEMO_VIDEO if p.get("type") == "video" else DEFAULT_DEMO_IMAGE),
-                                    caption=caption, reply_markup=pack_actions(pid))
-                return
-
-            # BUY flow: create order in DB then show payment buttons (Pay with Crypto)
-            if data.startswith("buy:"):
-                pid = data.split(":", 1)[1]
-                if pid not in PACKS:
-                    send_message(chat_id, "Product not found.")
-                    return
-                order = create_order_db(chat_id, pid)
-                send_message(
-                    chat_id,
-                    f"🧾 Order created: <b>{order['order_id']}</b>\nProduct: {pid}\nPrice: {order['price']} {order['currency']}\n\nChoose payment method:",
-                    reply_markup=payment_select_for_order(order["order_id"])
-                )
-                return
-
-            # cancel (works for either order or pack callbacks)
-            if data.startswith("cancel:"):
-                oid = data.split(":", 1)[1]
-                o = get_order_db(oid)
-                if o and o["user_id"] == chat_id:
-                    session = SessionLocal()
-                    try:
-                        dbo = session.query(Order).filter_by(order_id=oid).first()
-                        if dbo and dbo.status == "pending":
-                            dbo.status = "cancelled"
-                            session.commit()
-                            send_message(chat_id, f"Order {oid} cancelled.")
-                        else:
-                            send_message(chat_id, "Order not found or cannot cancel.")
-                    finally:
-                        session.close()
-                else:
-                    send_message(chat_id, "Returning to main menu.", reply_markup=main_menu())
-                return
-
-            # pay_now -> create invoice with NowPayments and return pay_url (no currency selection)
-            if data.startswith("pay_now:"):
-                oid = data.split(":", 1)[1]
-                order = get_order_db(oid)
-                if not order:
-                    send_message(chat_id, "Order not found.")
-                    return
-                invoice = create_invoice_nowpayments_db(order)
-                pay_url = invoice.get("pay_url") or invoice.get("invoice_url") or invoice.get("url") or f"{PUBLIC_URL}/pay/{oid}"
-                send_message(
-                    chat_id,
-                    f"Invoice created.\n\nPay here: {pay_url}\n\nAfter payment press <b>I Paid (check)</b>.",
-                    reply_markup=invoice_kb(oid)
-                )
-                return
-
-            # retry -> new invoice for the same order
-            if data.startswith("retry:"):
-                oid = data.split(":", 1)[1]
-                order = get_order_db(oid)
-                if not order:
-                    send_message(chat_id, "Order not found.")
-                    return
-                invoice = create_invoice_nowpayments_db(order)
-                pay_url = invoice.get("pay_url") or invoice.get("invoice_url") or invoice.get("url") or f"{PUBLIC_URL}/pay/{oid}"
-                send_message(chat_id, f"New invoice: {pay_url}", reply_markup=invoice_kb(oid))
-                return
-
-            # check_paid -> manual verification: if DB shows paid or invoice.status == paid, deliver
-            if data.startswith("check_paid:"):
-                oid = data.split(":", 1)[1]
-                o = get_order_db(oid)
-                if not o:
-                    send_message(chat_id, "Order not found.")
-                    return
-                invoice = o.get("invoice") or {}
-                if o["status"] == "paid" or (isinstance(invoice, dict) and invoice.get("status") == "paid"):
-                    mark_order_paid_db(oid, tx_info=invoice)
-                    send_message(chat_id, f"Order {oid} is already paid and delivered.")
-                else:
-                    send_message(chat_id, "Payment not detected yet. Please wait a few minutes and try again.")
-                return
+            prefix, _, arg = data.partition(":")
+            handler = CALLBACK_HANDLERS.get(prefix)
+            if handler:
+                handler(chat_id, arg, message_id)
 
     except Exception:
         logger.exception("handle_update failed")
         # do not crash the thread
 
 # ---------------- Routes ----------------
+# Bodies are fixed, so encode them once; a fresh Response per call keeps after-request hooks from sharing state.
+INDEX_BODY = f"{APP_NAME} is running 🚀".encode()
+HEALTH_BODY = b'{"status":"ok"}'
+
+
 @app.route("/")
 def index():
-    return f"{APP_NAME} is running 🚀"
+    return app.response_class(INDEX_BODY, mimetype="text/html")
 
 
 @app.route("/health")
 def health():
-    return jsonify({"status": "ok"})
+    return app.response_class(HEALTH_BODY, mimetype="application/json")
 
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    update = request.get_json(force=True)
-    threading.Thread(target=handle_update, args=(update,)).start()
+    raw = request.get_data()
+    # byte-level pre-filter: updates we never handle (edited_message, channel_post, ...) are acked unparsed
+    if b'"message"' not in raw and b'"callback_query"' not in raw:
+        return "ok", 200
+    try:
+        update = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        update = None
+    if not is_actionable_update(update):
+        return "ok", 200
+    UPDATE_STATS["received"] += 1
+    update["_t0"] = time.monotonic()
+    try:
+        UPDATE_QUEUE.put_nowait(update)
+    except queue.Full:
+        # still 200: a non-2xx makes Telegram redeliver into the same backlog
+        UPDATE_STATS["dropped"] += 1
+        logger.warning("Update queue full, dropping update %s", update.get("update_id"))
     return "ok", 200
 
 
+@app.route("/metrics")
+def metrics():
+    body = orjson.dumps({**UPDATE_STATS, "queued": UPDATE_QUEUE.qsize(), "workers": UPDATE_WORKERS,
+                         "send_queued": SEND_QUEUE.qsize(), "send_dropped": SEND_STATS["dropped"]})
+    return app.response_class(body, mimetype="application/json")
+
+
+def ipn_field(data, *keys):
+    # first truthy value among keys; a (parent, key) tuple looks one level down, e.g. ("invoice", "status")
+    for key in keys:
+        if isinstance(key, tuple):
+            parent = data.get(key[0])
+            value = parent.get(key[1]) if isinstance(parent, dict) else None
+        else:
+            value = data.get(key)
+        if value:
+            return value
+    return None
+
+
+def ipn_signature_ok(raw, data, received_sig):
+    """
+    NowPayments signs the key-sorted compact JSON of the payload. When the body already arrives in
+    that form, the raw bytes verify directly; otherwise re-serialize (orjson: sorted, raw UTF-8 like JS).
+    """
+    key = NOWPAYMENTS_IPN_SECRET.encode()
+    received = received_sig.encode()
+    if hmac.compare_digest(hmac.new(key, raw, hashlib.sha512).hexdigest().encode(), received):
+        return True
+    sorted_json = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return hmac.compare_digest(hmac.new(key, sorted_json, hashlib.sha512).hexdigest().encode(), received)
+
+
 @app.route("/nowpayments_webhook", methods=["POST"])
 def nowpayments_webhook():
     try:
-        data = request.get_json(force=True)
+        data = orjson.loads(request.get_data(cache=True))
+        if not isinstance(data, dict):
+            raise ValueError("IPN body is not a JSON object")
     except Exception:
         logger.exception("Invalid JSON in webhook")
         return jsonify({"ok": False}), 400
 
-    logger.info("NowPayments webhook received: %s", data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("NowPayments webhook received: %s", data)
 
     received_sig = request.headers.get("x-nowpayments-sig")
-    if NOWPAYMENTS_IPN_SECRET and received_sig:
-        sorted_json = json.dumps(data, separators=(',', ':'), sort_keys=True)
-        generated_sig = hmac.new(NOWPAYMENTS_IPN_SECRET.encode(), sorted_json.encode(), hashlib.sha512).hexdigest()
-        if generated_sig != received_sig:
+    if NOWPAYMENTS_IPN_SECRET:
+        # with a secret configured an unsigned IPN is as untrusted as a badly signed one
+        if not received_sig or not ipn_signature_ok(request.get_data(cache=True), data, received_sig):
             logger.warning("Invalid NOWPayments signature")
             return jsonify({"ok": False, "reason": "invalid_signature"}), 403
 
-    order_id = data.get("order_id") or data.get("orderId") or (data.get("invoice") or {}).get("order_id") or data.get("purchase_id")
-    status = data.get("status") or data.get("payment_status") or (data.get("invoice") or {}).get("status")
+    order_id = ipn_field(data, "order_id", "orderId", ("invoice", "order_id"), "purchase_id")
+    status = ipn_field(data, "status", "payment_status", ("invoice", "status"))
+
+    logger.info("NowPayments webhook: order=%s status=%s", order_id, status)
 
     if not order_id:
         logger.warning("No order_id in webhook payload")
         return jsonify({"ok": False, "reason": "no_order_id"}), 400
 
-    if str(status).lower() in ("finished", "paid", "success", "confirmed"):
-        o = get_order_db(order_id)
+    # retries (and late intermediate statuses) for an order that's already paid need no work at all;
+    # a stale cached "pending" just falls through to the guarded UPDATE below
+    o = get_order_db(order_id)
+    if o and o["status"] == "paid":
+        return jsonify({"ok": True, "idempotent": True}), 200
+
+    payment_ref = ipn_field(data, "payment_id", "invoice_id")
+    if payment_ref is not None and not claim_webhook_db(f"{payment_ref}:{status}"):
+        logger.info("Duplicate NowPayments webhook for order %s (%s), skipping", order_id, status)
+        return jsonify({"ok": True, "dedup": True}), 200
+
+    # exact match first (NowPayments sends lowercase); isinstance also keeps unhashable junk out of the set lookup
+    if isinstance(status, str) and (status in PAID_STATUSES or status.lower() in PAID_STATUSES):
         if o:
-            pay_amount = data.get("price_amount") or data.get("pay_amount") or (data.get("invoice") or {}).get("price_amount")
+            pay_amount = ipn_field(data, "price_amount", "pay_amount", ("invoice", "price_amount"))
             try:
                 if pay_amount is not None and float(pay_amount) < float(o["price"]) * 0.99:
                     logger.warning("Paid amount %s less than expected %s for order %s", pay_amount, o["price"], order_id)
@@ -777,25 +1617,52 @@ def nowpayments_webhook():
         mark_order_paid_db(order_id, tx_info=data)
         return jsonify({"ok": True}), 200
     else:
-        update_order_invoice_db(order_id, {"status": status})
+        # keep payment_id so "I Paid (check)" can poll NowPayments if the final IPN never arrives
+        update_order_invoice_db(order_id, {"status": status, "payment_id": data.get("payment_id")})
         return jsonify({"ok": True, "status": status}), 200
 
+@app.route("/media/<fid>")
+def media_proxy(fid):
+    # streams a known Drive file for Telegram to fetch (see send_via_proxy)
+    if fid not in MEDIA_DRIVE_IDS:
+        return "Not found", 404
+    try:
+        r = DRIVE_SESSION.get(gdrive_uc_url(fid), timeout=(3.05, 60), stream=True)
+    except requests.RequestException as e:
+        logger.warning("Drive fetch failed for %s: %s", fid, e)
+        return "Upstream error", 502
+    if not r.ok:
+        r.close()
+        return "Upstream error", 502
+
+    def body():
+        # pass the bytes through undecoded so they match the forwarded Content-Length/Content-Encoding
+        try:
+            yield from r.raw.stream(1 << 20, decode_content=False)
+        finally:
+            r.close()
+
+    headers = {k: r.headers[k] for k in ("Content-Length", "Content-Encoding") if r.headers.get(k)}
+    return Response(stream_with_context(body()), content_type=r.headers.get("Content-Type"), headers=headers)
+
 # Simple local fake pay page (for development)
-@app.route("/pay/<order_id>")
-def pay_page(order_id):
-    o = get_order_db(order_id)
-    if not o:
-        return "Order not found", 404
-    html = f"""
+PAY_PAGE_HTML = """
     <html><body>
       <h3>Fake pay page for order {order_id}</h3>
-      <p>Amount: {o['price']} {o['currency']}</p>
+      <p>Amount: {price} {currency}</p>
       <form action="/pay_simulate/{order_id}" method="post">
         <button type="submit">Simulate payment (mark as paid)</button>
       </form>
     </body></html>
     """
-    return html
+
+
+@app.route("/pay/<order_id>")
+def pay_page(order_id):
+    o = get_order_db(order_id)
+    if not o:
+        return "Order not found", 404
+    return PAY_PAGE_HTML.format(order_id=order_id, price=o["price"], currency=o["currency"])
 
 
 @app.route("/pay_simulate/<order_id>", methods=["POST"])
@@ -809,10 +1676,8 @@ def pay_simulate(order_id):
 
 # ---------------- Run ----------------
 if __name__ == "__main__":
-    if not BOT_TOKEN:
-        logger.warning("BOT_TOKEN is NOT set. Telegram messages will fail.")
-    if not NOWPAYMENTS_API_KEY:
-        logger.warning("NOWPAYMENTS_API_KEY is NOT set. Invoices will be simulated.")
     logger.info("Starting %s ...", APP_NAME)
+    # production runs `gunicorn -k gevent wsgi:app` (Procfile); this is the single-process dev server
+    logger.warning("Using the Flask development server; run under gunicorn (see Procfile) in production.")
     port = int(os.getenv("PORT", 8000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
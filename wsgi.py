@@ -0,0 +1,22 @@
+"""
+WSGI entry point for gunicorn (see Procfile).
+
+gevent must patch socket/ssl/threading before app imports requests, urllib3 and the DB driver,
+so every outbound Telegram/NowPayments/Postgres call yields to other greenlets while it waits.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+# libpq waits on its own sockets, which patch_all can't reach; psycogreen makes psycopg2 yield to the hub
+# instead of blocking the whole worker on every query. Skipped when psycopg2 isn't installed (sqlite).
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    pass
+else:
+    patch_psycopg()
+
+from app import app  # noqa: E402
+
+__all__ = ["app"]